@@ -0,0 +1,24 @@
+import functools
+from typing import Dict
+
+import yaml
+
+try:
+    # C-based parser, available if PyYAML was built with libyaml
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+@functools.lru_cache(maxsize=1)
+def load_config() -> Dict:
+    """
+    Provides the configuration of the service, which is parsed from the `config.yml` file only once
+
+    Returns
+    -------
+    `Dict`
+        The parsed configuration, which is shared by all callers and must therefore not be modified
+    """
+    with open('config.yml') as file:
+        return yaml.load(file, Loader=SafeLoader)
@@ -1,83 +1,200 @@
 import logging
 import os
+import sched
 import shutil
 import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Callable, Dict, List, Optional, Union
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
 from zipfile import ZipFile
 
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-import schedule
-import yaml
+import shapely
 from aimlsse_api.data import QueryStates
 from sentinelsat import (InvalidChecksumError, InvalidKeyError, LTAError,
                          LTATriggered, SentinelAPI, ServerError)
 from shapely import Point, Polygon
 
 from . import LocationToGridCellsMapper, SentinelImageProcessor
+from .config import load_config
 
 
 class RequestScheduler(object):
+    schedule_columns = ['state', 'last_query', 'title']
+    download_states = frozenset([
+        QueryStates.NEW,
+        QueryStates.PENDING,
+        QueryStates.INCOMPLETE
+    ])
+    """States of requests whose data still has to be downloaded"""
+    state_dtype = pd.CategoricalDtype([state.value for state in QueryStates])
+    """Stores states as small integer codes instead of one string per request"""
+    retry_interval = 30 * 60
+    """Seconds to wait before retrying to download data that was not available yet"""
+    api_cache_size = 64
+    """Number of users whose API, and thereby HTTP session, is kept"""
+    product_metadata_cache_size = 4096
+    """Number of products whose metadata is kept"""
+
+    __instance_lock = threading.Lock()
+
     def __new__(cls):
         if not hasattr(cls, 'instance'):
-            cls.instance = super(RequestScheduler, cls).__new__(cls)
-            cls.initialized = False
+            with cls.__instance_lock:
+                # Check again, another thread may have created the instance while waiting for the lock
+                if not hasattr(cls, 'instance'):
+                    instance = super(RequestScheduler, cls).__new__(cls)
+                    instance.__initialize()
+                    cls.instance = instance
         return cls.instance
     
-    def __init__(self) -> None:
+    def __initialize(self) -> None:
         self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
-        if RequestScheduler.initialized:
-            self.logger.debug('Already initialized - skipping')
-        else:
-            self.logger.debug('Initializing..')
-            config = yaml.safe_load(open('config.yml'))['copernicus']
-            self.data_dir: str = config['data-dir']
-            self.schedule_filepath: str = config['schedule-filepath']
-            os.makedirs(self.data_dir, exist_ok=True)
-            os.makedirs(os.path.dirname(self.schedule_filepath), exist_ok=True)
-            self.schedule: pd.DataFrame = None
-            if os.path.exists(self.schedule_filepath):
-                self.schedule = pd.read_csv(self.schedule_filepath, index_col='id')
-            else:
-                self.schedule = pd.DataFrame(columns=['state', 'last_query', 'title'])
-                self.schedule.index.name = 'id'
-            self.logger.debug(self.schedule)
-            self.active_requests: Dict[str, schedule.Job] = {}
-            self.run_as_thread(self.run_scheduler)
-            RequestScheduler.initialized = True
+        self.logger.debug('Initializing..')
+        config = load_config()['copernicus']
+        self.data_dir: str = config['data-dir']
+        self.schedule_filepath: str = config['schedule-filepath']
+        self.unzip_products: bool = config['unzip-products']
+        os.makedirs(self.data_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(self.schedule_filepath), exist_ok=True)
+        # Requests are kept as rows by id, since inserting into a DataFrame copies all of it
+        self.schedule: Dict[str, Dict] = self.__load_schedule()
+        self.logger.debug(self.schedule)
+        self.scheduler = sched.scheduler(time.monotonic, self.__wait_for_scheduler)
+        self.scheduler_wakeup = threading.Event()
+        self.active_requests: Dict[str, sched.Event] = {}
+        # Ids whose data is being downloaded right now, so that no second download of the same data is started
+        self.downloading: Set[str] = set()
+        # Downloads are run by a pool, so that long downloads do not block the scheduler or each other
+        self.download_pool = ThreadPoolExecutor(max_workers=config['download-workers'])
+        self.lock = threading.RLock()
+        self.apis: 'OrderedDict[str, Tuple[str, SentinelAPI]]' = OrderedDict()
+        self.product_metadata: 'OrderedDict[str, Dict]' = OrderedDict()
+        self.run_as_thread(self.run_scheduler)
 
     def run_as_thread(self, function:Callable):
-        thread = threading.Thread(target=function)
+        # Daemon threads do not prevent the process from exiting
+        thread = threading.Thread(target=function, daemon=True)
         thread.start()
 
     def run_scheduler(self):
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            self.scheduler.run()
+            # Nothing is scheduled anymore - sleep until a new download is scheduled
+            self.__wait_for_scheduler(None)
 
-    def store_schedule(self):
-        self.schedule.to_csv(self.schedule_filepath, index_label='id')
+    def __wait_for_scheduler(self, timeout:Optional[float]):
+        # Scheduling a download wakes the scheduler up early, so that it can re-evaluate its queue
+        if self.scheduler_wakeup.wait(timeout):
+            self.scheduler_wakeup.clear()
+
+    def __schedule_download(self, id:str, username:str, password:str):
+        with self.lock:
+            self.active_requests[id] = self.scheduler.enter(RequestScheduler.retry_interval, 1,
+                self.download_pool.submit, (self.__retry_download, id, username, password))
+        self.scheduler_wakeup.set()
+
+    def __cancel_download(self, id:str):
+        with self.lock:
+            event = self.active_requests.pop(id, None)
+        if event is not None:
+            try:
+                self.scheduler.cancel(event)
+            except ValueError:
+                # The event is currently being executed
+                pass
 
-    def __get_request(self, id:str) -> Optional[pd.DataFrame]:
+    def __retry_download(self, id:str, username:str, password:str):
+        # The request stays marked as downloading until the retry is done, so that polls do not start another download
+        with self.lock:
+            self.active_requests.pop(id, None)
+            if id in self.downloading:
+                self.logger.debug(f'Data for id {id} is already being downloaded - skipping retry')
+                return
+            self.downloading.add(id)
         try:
-            return self.schedule.loc[id]
-        except KeyError:
-            return None
+            if self.__get_request(id) is None:
+                self.logger.debug(f'Request for id {id} was removed - stopping download schedule')
+                return
+            if not self.__try_download_with_local_checks(id, username, password) \
+                    and self.__should_download(self.__check_state(id)):
+                self.__schedule_download(id, username, password)
+        finally:
+            with self.lock:
+                self.downloading.discard(id)
+        self.store_schedule()
+
+    def __load_schedule(self) -> Dict[str, Dict]:
+        filepath = self.schedule_filepath
+        # Fall back to a schedule that was stored as CSV by earlier versions
+        legacy_filepath = os.path.splitext(filepath)[0] + '.csv'
+        if not os.path.exists(filepath) and os.path.exists(legacy_filepath):
+            filepath = legacy_filepath
+        if not os.path.exists(filepath):
+            return {}
+        if filepath.endswith('.parquet'):
+            data = pd.read_parquet(filepath)
+        else:
+            data = pd.read_csv(filepath, index_col='id')
+        data['last_query'] = pd.to_datetime(data['last_query'])
+        return data.to_dict(orient='index')
+
+    def store_schedule(self):
+        with self.lock:
+            data = pd.DataFrame.from_dict(self.schedule, orient='index', columns=RequestScheduler.schedule_columns)
+            data.index.name = 'id'
+            data['state'] = data['state'].astype(RequestScheduler.state_dtype)
+            data['last_query'] = pd.to_datetime(data['last_query'])
+            if self.schedule_filepath.endswith('.parquet'):
+                data.to_parquet(self.schedule_filepath, compression='zstd')
+            else:
+                data.to_csv(self.schedule_filepath)
+
+    def __get_request(self, id:str) -> Optional[Dict]:
+        return self.schedule.get(id)
     
-    def __get_requests_by_state(self, state:QueryStates) -> pd.DataFrame:
-        return self.schedule[self.schedule['state'] == state]
+    def __get_requests_by_state(self, state:QueryStates) -> Dict[str, Dict]:
+        return {id: request for id, request in self.schedule.items() if request['state'] == state.value}
+
+    def __get_api(self, username:str, password:str) -> SentinelAPI:
+        # Reuse one API per user, so that its HTTP session is kept alive across requests
+        # Only the most recently used APIs are kept, and an API is replaced when the password of its user changes
+        with self.lock:
+            entry = self.apis.get(username)
+            if entry is None or entry[0] != password:
+                entry = (password, SentinelAPI(username, password))
+                self.apis[username] = entry
+            self.apis.move_to_end(username)
+            if len(self.apis) > RequestScheduler.api_cache_size:
+                self.apis.popitem(last=False)
+            return entry[1]
+
+    def __get_product_metadata(self, id:str, username:str, password:str) -> Dict:
+        # The metadata of a product is the same for all users, so it is cached by the id of the product only
+        # Failed lookups raise and are therefore not cached
+        with self.lock:
+            metadata = self.product_metadata.get(id)
+            if metadata is not None:
+                self.product_metadata.move_to_end(id)
+                return metadata
+        metadata = self.__get_api(username, password).get_product_odata(id)
+        with self.lock:
+            self.product_metadata[id] = metadata
+            if len(self.product_metadata) > RequestScheduler.product_metadata_cache_size:
+                self.product_metadata.popitem(last=False)
+        return metadata
 
     def request(self, id:str, username:str, password:str) -> QueryStates:
-        api = SentinelAPI(username, password)
         request = self.__get_request(id)
         self.logger.debug(f'Request for id {id} was {request}')
         if request is None:
             try:
-                metadata = api.get_product_odata(id)
+                metadata = self.__get_product_metadata(id, username, password)
             except InvalidKeyError:
                 self.logger.warning(f'Product with id {id} does not exist online - request will not be made')
                 return QueryStates.INVALID
@@ -86,20 +203,30 @@ class RequestScheduler(object):
                 'last_query': None,
                 'title': metadata['title']
             }
-            self.schedule = pd.concat([self.schedule, pd.DataFrame(new_request, index=[id])])
+            with self.lock:
+                self.schedule[id] = new_request
             self.logger.info(f'Added new request: {new_request}')
         else:
             state = self.__check_state(id)
             self.logger.info(f'Request already made - state is: {state}')
         state = self.__check_state(id)
-        should_download = id not in self.active_requests and self.__should_download(state)
+        # Checking and marking the download happen at once, so that concurrent requests do not both download
+        with self.lock:
+            should_download = id not in self.active_requests and id not in self.downloading \
+                and self.__should_download(state)
+            if should_download:
+                self.downloading.add(id)
         self.logger.debug(f'State is {state} - should download? {should_download}')
         if should_download:
-            self.logger.info(f'Try to download directly..')
-            if not self.__try_download_with_local_checks(id, username, password):
-                self.logger.info(f'Data unavailable - starting download schedule..')
-                job = schedule.every(30).minutes.do(self.__try_download_with_local_checks, id, username, password)
-                self.active_requests[id] = job
+            try:
+                self.logger.info(f'Try to download directly..')
+                if not self.__try_download_with_local_checks(id, username, password) \
+                        and self.__should_download(self.__check_state(id)):
+                    self.logger.info(f'Data unavailable - starting download schedule..')
+                    self.__schedule_download(id, username, password)
+            finally:
+                with self.lock:
+                    self.downloading.discard(id)
             request = self.__get_request(id)
             state = self.__check_state(id)
         return QueryStates(state)
@@ -109,7 +236,7 @@ class RequestScheduler(object):
         if request is None:
             raise ValueError(f'There is no request with id {id}')
         state = self.__check_state(id)
-        self.schedule.loc[id]['state'] = state
+        self.schedule[id]['state'] = state.value
         if state != QueryStates.AVAILABLE:
             raise ValueError(f'Only requests of state {QueryStates.AVAILABLE.name} may be processed - actual state was {state}')
     
@@ -122,26 +249,52 @@ class RequestScheduler(object):
             # Extract zip file like S2A_MSIL1C_20220104T103431_N0301_R108_T32UMA_20220104T123507.zip
             # to S2A_MSIL1C_20220104T103431_N0301_R108_T32UMA_20220104T123507.SAFE/
             with ZipFile(filepath_zip) as zip_file:
-                zip_file.extractall(self.data_dir)
+                entries = zip_file.infolist()
+                # Create all directories upfront, since concurrent extractions would race to create them
+                directories = {os.path.dirname(self.__get_extraction_path(entry.filename)) for entry in entries}
+                for directory in directories:
+                    os.makedirs(directory, exist_ok=True)
+                # Inflate the entries concurrently - zlib releases the GIL while decompressing
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    list(executor.map(lambda entry: zip_file.extract(entry, self.data_dir), entries))
             # Remove the original zip file so we do not have duplicates
             os.remove(filepath_zip)
         return dirpath_safe
 
+    def __get_extraction_path(self, filename:str) -> str:
+        # Sanitize the path like ZipFile.extract does, so that entries can not point outside the data directory
+        path = os.path.splitdrive(filename.replace('/', os.path.sep))[1]
+        components = [component for component in path.split(os.path.sep)
+            if component not in ('', os.path.curdir, os.path.pardir)]
+        return os.path.join(self.data_dir, *components)
+
+    def __get_product_path(self, id:str) -> str:
+        request = self.__get_request(id)
+        path_no_ext = os.path.join(self.data_dir, request['title'])
+        if self.unzip_products or os.path.isdir(path_no_ext + '.SAFE'):
+            return self.__unzip_product(id)
+        # The bands are read directly from the archive, which saves extracting it to disk
+        return path_no_ext + '.zip'
+
     def process_data_for_request(self, id:str, bands:List[str], locations:gpd.GeoDataFrame,
-            radius:float, remove_source:bool) -> str:
+            radius:float, remove_source:bool, out_dtype:Optional[str] = None) -> str:
         self.__assert_request_available(id)
-        product_dir = self.__unzip_product(id)
+        product_path = self.__get_product_path(id)
         # Extract features from the sentinel data
-        zip_filepath = SentinelImageProcessor().process(product_dir, id, bands, locations, radius)
+        zip_filepath = SentinelImageProcessor().process(product_path, id, bands, locations, radius, out_dtype)
         if remove_source:
-            shutil.rmtree(product_dir)
-        self.schedule.loc[id]['state'] = QueryStates.PROCESSED
+            if os.path.isdir(product_path):
+                shutil.rmtree(product_path)
+            else:
+                os.remove(product_path)
+        self.schedule[id]['state'] = QueryStates.PROCESSED.value
         return zip_filepath
     
     def remove_request(self, id:str):
-        if id not in self.schedule.index:
+        if id not in self.schedule:
             self.logger.warn(f'Request with id {id} can not be removed because it does not exist')
             return
+        self.__cancel_download(id)
         SentinelImageProcessor().remove(id)
         try:
             self.__assert_request_available(id)
@@ -158,7 +311,9 @@ class RequestScheduler(object):
         except:
             pass
         self.logger.debug(f'Removing request for id {id}..')
-        self.schedule.drop(id, inplace=True)
+        with self.lock:
+            del self.schedule[id]
+            self.product_metadata.pop(id, None)
 
     def get_raw_product(self, id:str) -> str:
         self.__assert_request_available(id)
@@ -170,79 +325,83 @@ class RequestScheduler(object):
         if request is None:
             raise ValueError(f'There is no request for {id} - create one first')
         self.logger.debug(f'Checking availability for request {request}')
-        files = list(filter(lambda x: x.startswith(request['title']), os.listdir(self.data_dir)))
-        self.logger.debug(f'Found {len(files)} files for id {id}:\n{files}')
+        # Single pass over the directory - an incomplete download outweighs any other file, so stop there
+        is_downloaded = False
+        is_incomplete = False
+        with os.scandir(self.data_dir) as entries:
+            for entry in entries:
+                if not entry.name.startswith(request['title']):
+                    continue
+                if entry.name.endswith('.incomplete'):
+                    is_incomplete = True
+                    break
+                if entry.name.endswith(('.zip', '.SAFE')):
+                    is_downloaded = True
         state = QueryStates(request['state'])
-        if any(filter(lambda x: x.endswith('.zip') or x.endswith('.SAFE'), files)):
+        if is_incomplete:
+            state = QueryStates.INCOMPLETE
+        elif is_downloaded:
             state = QueryStates.AVAILABLE
         elif state == QueryStates.AVAILABLE:
             state = QueryStates.NEW
-        if any(filter(lambda x: x.endswith('.incomplete'), files)):
-            state = QueryStates.INCOMPLETE
-        self.schedule.loc[id]['state']
+        self.logger.debug(f'Checked state for id {id} is {state}')
+        self.schedule[id]['state'] = state.value
         return state
 
     def __should_download(self, state:QueryStates) -> bool:
-        return state in [
-            QueryStates.NEW,
-            QueryStates.PENDING,
-            QueryStates.INCOMPLETE
-        ]
+        return state in RequestScheduler.download_states
 
-    def __try_download_sentinel_data(self, id:str, api:SentinelAPI):
+    def __try_download_sentinel_data(self, id:str, api:SentinelAPI, query_time:np.datetime64):
         request = self.__get_request(id)
-        self.logger.debug(f'Trying to download request\n{request} at index {request.index}')
+        self.logger.debug(f'Trying to download request\n{request} for id {id}')
         if request is None:
             raise ValueError(f'Unable to prepare download for id {id} - the request does not exist')
         old_state = request['state']
         try:
-            self.schedule.loc[id]['state'] = QueryStates.INCOMPLETE.value
+            self.schedule[id]['state'] = QueryStates.INCOMPLETE.value
             self.logger.debug(f'Initiating download for id {id}')
             api.download(id, directory_path=self.data_dir)
-            self.schedule.loc[id]['state'] = QueryStates.AVAILABLE.value
-            if id in self.active_requests:
-                job = self.active_requests.pop(id)
-                schedule.cancel_job(job)
+            self.schedule[id]['state'] = QueryStates.AVAILABLE.value
+            self.__cancel_download(id)
         except LTATriggered:
-            self.schedule.loc[id]['state'] = QueryStates.PENDING.value
+            self.schedule[id]['state'] = QueryStates.PENDING.value
             self.logger.info(f'Data for id {id} is not available - a request to retrieve it from the LTA has been initiated')
         except LTAError:
-            self.schedule.loc[id]['state'] = QueryStates.UNAVAILABLE.value
+            self.schedule[id]['state'] = QueryStates.UNAVAILABLE.value
             self.logger.info(f'Data for id {id} is not available - no request could be initiated')
         except ServerError as error:
             self.logger.error(f'Copernicus server error: {error.msg}')
             if 'NullPointerException' in error.msg:
-                self.schedule.loc[id]['state'] = QueryStates.UNAVAILABLE
+                self.schedule[id]['state'] = QueryStates.UNAVAILABLE.value
             else:
                 # The server is probably down for maintainance
-                self.schedule.loc[id]['state'] = old_state
+                self.schedule[id]['state'] = old_state
         except InvalidChecksumError:
             self.logger.error(f'Invalid checksum of download')
-            self.schedule.loc[id]['state'] = old_state
+            self.schedule[id]['state'] = old_state
             request = self.__get_request(id)
             filepath_zip = os.path.join(self.data_dir, request['title'] + '.zip')
             if os.path.exists(filepath_zip):
                 os.remove(filepath_zip)
             else:
-                self.schedule.loc[id]['state'] = QueryStates.UNAVAILABLE
+                self.schedule[id]['state'] = QueryStates.UNAVAILABLE.value
 
-        self.schedule.loc[id]['last_query'] = np.datetime64('now')
+        self.schedule[id]['last_query'] = query_time
 
     def __try_download_with_local_checks(self, id:str, username:str, password:str) -> bool:
-        api = SentinelAPI(username, password)
+        api = self.__get_api(username, password)
         request = self.__get_request(id)
         if request is None:
             raise ValueError(f'There is no request for {id} - create one first')
         # Check if data is locally available
         checked_state = self.__check_state(id)
         if not self.__should_download(checked_state):
-            self.logger.debug('Data is available in storage')
-            if id in self.active_requests:
-                self.active_requests.remove(id)
-            return
+            self.logger.debug(f'No download required in state {checked_state}')
+            self.__cancel_download(id)
+            return checked_state == QueryStates.AVAILABLE
         self.logger.debug('Data unavailable - trying to download')
         self.logger.debug(f'Id: {id}, api: {api}')
-        self.__try_download_sentinel_data(id, api)
+        self.__try_download_sentinel_data(id, api, np.datetime64('now'))
         checked_state = self.__check_state(id)
         self.logger.debug(f'Current state is {checked_state} for id {id}')
         return checked_state == QueryStates.AVAILABLE
@@ -250,7 +409,7 @@ class RequestScheduler(object):
 class CopernicusAccess():
     def __init__(self, username:str, password:str) -> None:
         self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
-        config = yaml.safe_load(open('config.yml'))['copernicus']
+        config = load_config()['copernicus']
         self.search_url: str = config['search-url']
         self.username = username
         self.password = password
@@ -272,6 +431,11 @@ class CopernicusAccess():
         return self.password
 
     def __asZulu(self, dt:datetime):
+        if dt.tzinfo is timezone.utc:
+            return dt
+        if dt.tzinfo is None:
+            # Naive datetimes are interpreted as UTC, instead of the local time of the server
+            return dt.replace(tzinfo=timezone.utc)
         return dt.astimezone(timezone.utc)
 
     def searchFootprint(self, footprint:Union[Point, Polygon], datetime_from:datetime, datetime_to:datetime) -> pd.DataFrame:
@@ -285,15 +449,41 @@ class CopernicusAccess():
         return api.to_dataframe(products)
     
     def searchCell(self, cell_name:str, datetime_from:datetime, datetime_to:datetime) -> pd.DataFrame:
+        return self.searchCells([cell_name], datetime_from, datetime_to)[cell_name]
+
+    def searchCells(self, cell_names:List[str], datetime_from:datetime, datetime_to:datetime) -> Dict[str, pd.DataFrame]:
+        '''
+        Searches products for multiple grid-cells with a single query, instead of one query per grid-cell.
+
+        Parameters
+        ----------
+        cell_names: `List[str]`
+            The names of the grid-cells to search products for
+        datetime_from: `datetime`
+            The start of the time-span in which the products were sensed
+        datetime_to: `datetime`
+            The end of the time-span in which the products were sensed
+        
+        Returns
+        -------
+        `Dict[str, pandas.DataFrame]`
+            The products per grid-cell, whose footprints contain the centroid of the respective grid-cell
+        '''
         api = self.get_api()
-        cell = LocationToGridCellsMapper().get_cell(cell_name)
-        products = api.query(
-            cell.centroid,
+        cells = LocationToGridCellsMapper().get_cells(cell_names)
+        # The centroids are computed by shapely, since geopandas warns about centroids in a geographic CRS
+        centroids = pd.Series(shapely.centroid(cells.values), index=cells.index)
+        products = api.to_dataframe(api.query(
+            shapely.union_all(centroids.values),
             date=(self.__asZulu(datetime_from), self.__asZulu(datetime_to)),
             platformname='Sentinel-2',
             producttype='S2MSI1C'
-        )
-        return api.to_dataframe(products)
+        ))
+        if products.empty:
+            return {cell_name: products for cell_name in cell_names}
+        # Split the products by the grid-cells, like separate queries for each centroid would have done
+        footprints = shapely.from_wkt(products['footprint'].values)
+        return {cell_name: products[shapely.intersects(footprints, centroids[cell_name])] for cell_name in cell_names}
 
     def query_image(self, id:str, band:str):
         pass
\ No newline at end of file
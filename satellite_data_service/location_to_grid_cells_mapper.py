@@ -1,13 +1,21 @@
+import hashlib
 import logging
 import os
-from typing import Dict, List, Optional, Tuple
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 import fiona
 import geopandas as gpd
+import numpy as np
 import requests
-import yaml
+import shapely
 
-from shapely import GeometryCollection
+from shapely import GeometryCollection, box
+
+from .config import load_config
 
 class LocationToGridCellsMapper ():
     """Provides mappings from location-points to the grid-cells in which they are located"""
@@ -18,28 +26,178 @@ class LocationToGridCellsMapper ():
     Instead of using this variable directly, use the `get_grid()` method to make sure it is properly initialized.
     """
 
+    __grid_tree: Optional[shapely.STRtree] = None
+    """
+    The spatial index over the geometries of the grid, which is built together with the grid.
+    Instead of using this variable directly, use the `get_tree()` method to make sure it is properly initialized.
+    """
+
+    __grid_bounds: Optional[np.ndarray] = None
+    """
+    The bounding boxes of the geometries of the grid, stored as four contiguous rows of minx, miny, maxx and maxy,
+    which is built together with the grid
+    """
+
+    __grid_quads: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = None
+    """
+    The grid-cells that consist of a single convex quadrilateral, as used by almost all Sentinel-2 tiles.
+    It holds a mask of these cells and the counter-clockwise vertices and edges of their quadrilaterals as
+    `(mask, x, y, dx, dy)`, which is built together with the grid.
+    """
+
+    __grid_lock = threading.Lock()
+    """Guards the lazy initialization of the grid, since it is shared by all instances and threads"""
+
+    __refinement_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+    """
+    Runs the exact containment tests in parallel, which is possible since GEOS releases the GIL.
+    It is shared by all instances, since the threads are only started once they are needed.
+    """
+
+    refinement_chunk_size = 10000
+    """The minimal number of candidate pairs per parallel containment test, below which threads are not worth it"""
+
+    bounds_filter_max_locations = 16
+    """
+    The maximal number of locations, for which the candidate grid-cells are found by comparing bounding boxes
+    directly instead of querying the spatial index, since that is cheaper for few locations
+    """
+
+    __query_cache: 'OrderedDict[bytes, Tuple[np.ndarray, np.ndarray]]' = OrderedDict()
+    """
+    The most recent results of finding the grid-cells that contain a set of locations, keyed by a hash of the locations.
+    It is shared by all instances, since it depends on the grid only.
+    """
+
+    __query_cache_lock = threading.Lock()
+    """Guards the cache of query results against concurrent modification"""
+
     def __init__(self) -> None:
-        config = yaml.safe_load(open('config.yml'))
+        config = load_config()
         self.grid_filepath = config['grid']['filepath']
         self.grid_download_url = config['grid']['download-url']
+        self.grid_cache_filepath = config['grid']['cache-filepath']
+        self.query_cache_size: int = config['grid']['query-cache-size']
 
     def load_grid(self):
         """Provides a way to initialize and reload the grid"""
         logging.info('Loading Sentinel-Grid..')
+        if self.is_grid_cache_valid():
+            data: gpd.GeoDataFrame = gpd.read_parquet(self.grid_cache_filepath)
+        else:
+            data = self.convert_grid()
+        geometries = np.asarray(data.geometry.values)
+        # Prepare the cells once, so that containment tests reuse their internal edge indices instead of
+        # preparing the same cells again for every request
+        shapely.prepare(geometries)
+        # Build the spatial index once, so that all queries against the cached grid reuse it
+        LocationToGridCellsMapper.__grid_tree = shapely.STRtree(geometries)
+        LocationToGridCellsMapper.__grid_bounds = np.ascontiguousarray(shapely.bounds(geometries).T)
+        LocationToGridCellsMapper.__grid_quads = self.pack_quads(geometries)
+        LocationToGridCellsMapper.__grid = data
+        with LocationToGridCellsMapper.__query_cache_lock:
+            LocationToGridCellsMapper.__query_cache.clear()
+        logging.info('Sentinel-Grid loaded!')
+
+    @staticmethod
+    def pack_quads(geometries:np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Finds the grid-cells whose area consists of a single convex quadrilateral without holes, and packs the
+        vertices and edges of these quadrilaterals into contiguous arrays for a fast containment test.
+        Grid-cells that are composed differently, e.g. split at the antimeridian, are left to GEOS.
+
+        Parameters
+        ----------
+        geometries: `numpy.ndarray`
+            The geometries of the grid-cells, which may be collections of a polygon and points
+        
+        Returns
+        -------
+        `Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]`
+            The mask of the quadrilateral grid-cells, as well as the x- and y-coordinates of their vertices and
+            of their edges, in the form of `(N, 4)` arrays ordered counter-clockwise
+        """
+        parts, part_cell_indices = shapely.get_parts(geometries, return_index=True)
+        part_types = shapely.get_type_id(parts)
+        is_polygon = part_types == shapely.GeometryType.POLYGON
+        polygon_counts = np.bincount(part_cell_indices[is_polygon], minlength=len(geometries))
+        # Points do not change the containment of other points, but any other part would
+        other_counts = np.bincount(part_cell_indices[~is_polygon & (part_types != shapely.GeometryType.POINT)],
+            minlength=len(geometries))
+        is_single_polygon = (polygon_counts == 1) & (other_counts == 0)
+        polygons = np.empty(len(geometries), dtype=object)
+        polygons[part_cell_indices[is_polygon]] = parts[is_polygon]
+        exteriors = shapely.get_exterior_ring(polygons[is_single_polygon])
+        is_quad = (shapely.get_num_coordinates(exteriors) == 5) & (shapely.get_num_interior_rings(polygons[is_single_polygon]) == 0)
+        vertices = shapely.get_coordinates(exteriors[is_quad]).reshape(-1, 5, 2)[:, :4]
+        # Orient all quadrilaterals counter-clockwise, so that their interior is left of every edge
+        x, y = vertices[..., 0], vertices[..., 1]
+        is_clockwise = np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1) < 0
+        x[is_clockwise], y[is_clockwise] = x[is_clockwise, ::-1], y[is_clockwise, ::-1]
+        dx, dy = np.roll(x, -1, axis=1) - x, np.roll(y, -1, axis=1) - y
+        # The test is only valid for convex quadrilaterals, in which consecutive edges always turn left
+        is_convex = np.all(dx * np.roll(dy, -1, axis=1) - dy * np.roll(dx, -1, axis=1) > 0, axis=1)
+        quad_indices = np.flatnonzero(is_single_polygon)[is_quad][is_convex]
+        mask = np.zeros(len(geometries), dtype=bool)
+        mask[quad_indices] = True
+        packed = [np.zeros((len(geometries), 4)) for _ in range(4)]
+        for array, values in zip(packed, (x, y, dx, dy)):
+            array[quad_indices] = values[is_convex]
+        return (mask, *packed)
+
+    def is_grid_cache_valid(self) -> bool:
+        """
+        Checks whether the GeoParquet cache of the grid exists and is at least as recent as the original KML file,
+        so that a replaced KML file is converted again instead of being shadowed by an outdated cache
+
+        Returns
+        -------
+        `bool`
+            Whether the grid can be loaded from the cache
+        """
+        if not os.path.exists(self.grid_cache_filepath):
+            return False
         if not os.path.exists(self.grid_filepath):
-            os.makedirs(os.path.dirname(self.grid_filepath))
+            return True
+        return os.path.getmtime(self.grid_cache_filepath) >= os.path.getmtime(self.grid_filepath)
+
+    def convert_grid(self) -> gpd.GeoDataFrame:
+        """
+        Reads the grid from the original KML file, downloading it first if necessary,
+        and stores it as GeoParquet, which is much faster to load than KML.
+
+        Returns
+        -------
+        `geopandas.GeoDataFrame`
+            The grid that is composed of polygons, which in turn cover a certain area of the planet
+        """
+        if not os.path.exists(self.grid_filepath):
+            os.makedirs(os.path.dirname(self.grid_filepath), exist_ok=True)
             logging.info('Sentinel-Grid is not avaiable, downloading..')
-            response = requests.get(self.grid_download_url)
-            response.raise_for_status()
-            with open(self.grid_filepath, 'wb') as file:
-                file.write(response.content)
+            # Stream the grid to disk instead of holding the whole file in memory
+            # The download is moved into place only once it is complete, so that a failed download is not taken for the grid
+            download_filepath = self.grid_filepath + '.incomplete'
+            try:
+                with requests.get(self.grid_download_url, stream=True) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    with open(download_filepath, 'wb') as file:
+                        shutil.copyfileobj(response.raw, file, length=1024 * 1024)
+                os.replace(download_filepath, self.grid_filepath)
+            except BaseException:
+                if os.path.exists(download_filepath):
+                    os.remove(download_filepath)
+                raise
             logging.info('Sentinel-Grid download complete!')
 
+        logging.info('Converting Sentinel-Grid to GeoParquet..')
         fiona.supported_drivers['KML'] = 'rw' # enable KML support
         data: gpd.GeoDataFrame = gpd.read_file(self.grid_filepath)
         data.rename(columns={'Name': 'cell_name'}, inplace=True)
-        LocationToGridCellsMapper.__grid = data
-        logging.info('Sentinel-Grid loaded!')
+        os.makedirs(os.path.dirname(self.grid_cache_filepath), exist_ok=True)
+        data.to_parquet(self.grid_cache_filepath)
+        logging.info('Sentinel-Grid conversion complete!')
+        return data
 
     def get_grid(self) -> gpd.GeoDataFrame:
         """
@@ -51,9 +209,23 @@ class LocationToGridCellsMapper ():
             The grid that is composed of polygons, which in turn cover a certain area of the planet
         """
         if LocationToGridCellsMapper.__grid is None:
-            self.load_grid()
+            with LocationToGridCellsMapper.__grid_lock:
+                if LocationToGridCellsMapper.__grid is None:
+                    self.load_grid()
         return LocationToGridCellsMapper.__grid
 
+    def get_tree(self) -> shapely.STRtree:
+        """
+        Provides access to the spatial index over the grid, while making sure that it is initialized
+
+        Returns
+        -------
+        `shapely.STRtree`
+            The spatial index, whose positional indices correspond to the rows of the grid
+        """
+        self.get_grid()
+        return LocationToGridCellsMapper.__grid_tree
+
     def selectLocationContainingGridCells(self, locations:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
         """
         Selects all grid cells that contain the given location-points in the form of (longitude, latitude)
@@ -76,9 +248,10 @@ class LocationToGridCellsMapper ():
         grid = self.get_grid()
         logging.debug(grid)
         logging.info('Starting selection of grid-cells..')
-        result = grid.loc[grid.geometry.apply(lambda tile: any(tile.contains(locations.geometry)))]
+        _, cell_indices = self.__query_containing_cells(locations)
+        result = grid.iloc[np.unique(cell_indices)]
         logging.info('Selection of grid-cells complete!')
-        logging.debug(f'Result of selection: {result}')
+        logging.debug('Result of selection: %s', result)
         return result
 
     def mapLocationsToContainingGridCellLabels(self, locations:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
@@ -105,12 +278,176 @@ class LocationToGridCellsMapper ():
         grid = self.get_grid()
         logging.debug(grid)
         logging.info('Starting mapping of locations to grid-cells..')
-        # TODO - Find more efficient way of mapping
-        result = grid.sjoin(locations)
+        location_indices, cell_indices = self.__query_containing_cells(locations)
+        order = np.lexsort((location_indices, cell_indices))
+        cell_indices, location_indices = cell_indices[order], location_indices[order]
+        # Join the attributes of the locations by position in a single step, instead of a label-based merge
+        # Columns present in both are suffixed like sjoin does, so that neither overwrites the other
+        attributes = locations.columns.drop(locations.geometry.name)
+        overlapping = set(attributes).intersection(grid.columns.drop(grid.geometry.name))
+        result = grid.iloc[cell_indices].rename(columns={column: f'{column}_left' for column in overlapping}).assign(
+            index_right=locations.index.to_numpy()[location_indices],
+            **{f'{column}_right' if column in overlapping else str(column): locations[column].to_numpy()[location_indices]
+                for column in attributes}
+        )
         logging.info('Mapping of locations to grid-cells complete!')
-        logging.debug(f'Result of mapping: {result}')
+        logging.debug('Result of mapping: %s', result)
         return result
 
+    def __query_containing_cells(self, locations:gpd.GeoDataFrame) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds all pairs of locations and grid-cells, where the grid-cell contains the location.
+        The spatial index of the grid is probed once for all locations to find the candidate pairs by their
+        bounding boxes, which are then refined by exact containment tests against the prepared grid-cells.
+        The results for the most recently queried sets of locations are cached.
+
+        Parameters
+        ----------
+        locations: `geopandas.GeoDataFrame`
+            The locations-points in the form of (longitude, latitude) `geopandas.geometry.Point`s
+        
+        Returns
+        -------
+        `Tuple[numpy.ndarray, numpy.ndarray]`
+            The positional indices of the locations and of the grid-cells that contain them
+        """
+        tree = self.get_tree()
+        points = np.asarray(locations.geometry.values)
+        # Clients tend to query the same locations repeatedly, e.g. for different time ranges
+        key = hashlib.blake2b(b''.join(shapely.to_wkb(points)), digest_size=16).digest()
+        with LocationToGridCellsMapper.__query_cache_lock:
+            cached = LocationToGridCellsMapper.__query_cache.get(key)
+            if cached is not None:
+                LocationToGridCellsMapper.__query_cache.move_to_end(key)
+                return cached
+        if len(points) <= self.bounds_filter_max_locations:
+            location_indices, cell_indices = self.__query_bounds(points)
+        else:
+            location_indices, cell_indices = tree.query(points)
+        # Point locations are tested by their raw coordinates, which are extracted only once
+        is_point = (shapely.get_type_id(points) == shapely.GeometryType.POINT) & ~shapely.is_empty(points)
+        location_x, location_y = np.full((2, len(points)), np.nan)
+        location_x[is_point], location_y[is_point] = shapely.get_coordinates(points[is_point]).T
+        is_point_pair = is_point[location_indices]
+        contained = np.empty(len(cell_indices), dtype=bool)
+        # Quadrilateral cells are tested with a dedicated kernel, which skips the generic polygon machinery of GEOS
+        quad_mask, _, _, _, _ = LocationToGridCellsMapper.__grid_quads
+        is_quad_pair = quad_mask[cell_indices] & is_point_pair
+        quad_location_indices = location_indices[is_quad_pair]
+        contained[is_quad_pair] = self.__contains_quads(cell_indices[is_quad_pair],
+            location_x[quad_location_indices], location_y[quad_location_indices])
+        # A predicate passed to the query would be evaluated against the prepared input points instead,
+        # so the containment is tested separately to make use of the prepared grid-cells
+        is_xy_pair = is_point_pair & ~is_quad_pair
+        xy_location_indices = location_indices[is_xy_pair]
+        contained[is_xy_pair] = self.__contains(shapely.contains_xy, tree.geometries[cell_indices[is_xy_pair]],
+            location_x[xy_location_indices], location_y[xy_location_indices])
+        is_other_pair = ~is_point_pair
+        contained[is_other_pair] = self.__contains(shapely.contains, tree.geometries[cell_indices[is_other_pair]],
+            points[location_indices[is_other_pair]])
+        result = (location_indices[contained], cell_indices[contained])
+        for indices in result:
+            indices.setflags(write=False)
+        with LocationToGridCellsMapper.__query_cache_lock:
+            LocationToGridCellsMapper.__query_cache[key] = result
+            while len(LocationToGridCellsMapper.__query_cache) > self.query_cache_size:
+                LocationToGridCellsMapper.__query_cache.popitem(last=False)
+        return result
+
+    def __query_bounds(self, points:np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds all pairs of locations and grid-cells, whose bounding boxes intersect, by comparing them all at once.
+        Only the grid-cells within the envelope of all locations are compared, instead of the whole grid.
+
+        Parameters
+        ----------
+        points: `numpy.ndarray`
+            The locations to find the candidate grid-cells for
+        
+        Returns
+        -------
+        `Tuple[numpy.ndarray, numpy.ndarray]`
+            The positional indices of the locations and of the grid-cells whose bounding boxes intersect them
+        """
+        candidates = self.__query_envelope(points)
+        min_x, min_y, max_x, max_y = LocationToGridCellsMapper.__grid_bounds[:, candidates]
+        location_bounds = shapely.bounds(points)
+        intersecting = (location_bounds[:, [0]] <= max_x) & (location_bounds[:, [2]] >= min_x) \
+            & (location_bounds[:, [1]] <= max_y) & (location_bounds[:, [3]] >= min_y)
+        location_indices, candidate_indices = np.nonzero(intersecting)
+        return location_indices, candidates[candidate_indices]
+
+    def __query_envelope(self, points:np.ndarray) -> np.ndarray:
+        """
+        Finds the grid-cells whose bounding boxes intersect the envelope of all locations, which is a single cheap
+        query against the spatial index of the grid that excludes the vast majority of grid-cells
+
+        Parameters
+        ----------
+        points: `numpy.ndarray`
+            The locations to find the candidate grid-cells for
+        
+        Returns
+        -------
+        `numpy.ndarray`
+            The positional indices of the candidate grid-cells, in the original order of the grid
+        """
+        if len(points) == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(self.get_tree().query(box(*shapely.total_bounds(points))))
+
+    def __contains_quads(self, cell_indices:np.ndarray, point_x:np.ndarray, point_y:np.ndarray) -> np.ndarray:
+        """
+        Tests pairwise whether quadrilateral grid-cells contain the points, by checking that each point lies
+        strictly left of all counter-clockwise edges of its grid-cell, which is only valid for convex cells
+
+        Parameters
+        ----------
+        cell_indices: `numpy.ndarray`
+            The positional indices of the quadrilateral grid-cells to test
+        point_x: `numpy.ndarray`
+            The x-coordinates of the points to test, of the same length as the indices
+        point_y: `numpy.ndarray`
+            The y-coordinates of the points to test, of the same length as the indices
+        
+        Returns
+        -------
+        `numpy.ndarray`
+            The boolean results of the containment tests
+        """
+        _, x, y, dx, dy = LocationToGridCellsMapper.__grid_quads
+        point_x, point_y = point_x[:, np.newaxis], point_y[:, np.newaxis]
+        cell_x, cell_y = x[cell_indices], y[cell_indices]
+        cross_products = dx[cell_indices] * (point_y - cell_y) - dy[cell_indices] * (point_x - cell_x)
+        return np.all(cross_products > 0, axis=1)
+
+    def __contains(self, predicate:Callable[..., np.ndarray], cells:np.ndarray, *locations:np.ndarray) -> np.ndarray:
+        """
+        Tests pairwise whether the grid-cells contain the locations, splitting large inputs into chunks that are
+        tested in parallel
+
+        Parameters
+        ----------
+        predicate: `Callable[..., numpy.ndarray]`
+            The vectorized containment test, i.e. `shapely.contains` or `shapely.contains_xy`
+        cells: `numpy.ndarray`
+            The grid-cells to test, preferably prepared
+        locations: `numpy.ndarray`
+            The locations to test as required by the predicate, i.e. as geometries or as x- and y-coordinates,
+            of the same length as the grid-cells
+        
+        Returns
+        -------
+        `numpy.ndarray`
+            The boolean results of the containment tests
+        """
+        chunk_count = min(os.cpu_count() or 1, len(cells) // self.refinement_chunk_size)
+        if chunk_count <= 1:
+            return predicate(cells, *locations)
+        chunks = self.__refinement_pool.map(predicate,
+            *(np.array_split(array, chunk_count) for array in (cells, *locations)))
+        return np.concatenate(list(chunks))
+
     def get_cell(self, name:str) -> GeometryCollection:
         grid = self.get_grid()
         cells = grid[grid['cell_name'] == name]
@@ -118,4 +455,30 @@ class LocationToGridCellsMapper ():
             raise ValueError(f'There is no cell with name {name}')
         cell = cells['geometry'].iloc[0]
         assert isinstance(cell, GeometryCollection), f'Geometry field of cell {name} is not a GeometryCollection'
-        return cell
\ No newline at end of file
+        return cell
+
+    def get_cells(self, names:List[str]) -> gpd.GeoSeries:
+        """
+        Looks up the geometries of multiple grid-cells at once
+
+        Parameters
+        ----------
+        names: `List[str]`
+            The names of the grid-cells
+        
+        Raises
+        ------
+        `ValueError`
+            If any of the names does not belong to a grid-cell
+        
+        Returns
+        -------
+        `geopandas.GeoSeries`
+            The geometries of the grid-cells, indexed by their names
+        """
+        grid = self.get_grid()
+        cells = grid[grid['cell_name'].isin(names)].drop_duplicates('cell_name')
+        missing_names = set(names).difference(cells['cell_name'])
+        if missing_names:
+            raise ValueError(f'There are no cells with names {missing_names}')
+        return cells.set_index('cell_name')['geometry']
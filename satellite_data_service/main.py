@@ -1,24 +1,33 @@
 import json
 import logging
+from contextlib import asynccontextmanager
 from datetime import datetime
 from http import HTTPStatus
 from pathlib import Path
-from typing import Annotated, List, Union
+from typing import Annotated, List, Optional, Union
 
+import anyio
 import geopandas as gpd
+import numpy as np
 import shapely
-import yaml
 from aimlsse_api.interface import SatelliteDataAccess
 from fastapi import APIRouter, Body, Depends, FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import (FileResponse, ORJSONResponse,
+                               PlainTextResponse, Response)
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from shapely import Point, Polygon
 from starlette.background import BackgroundTask
 
 from . import CopernicusAccess, LocationToGridCellsMapper, RequestScheduler
+from .config import load_config
 
-logging.basicConfig(level=logging.DEBUG)
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app:FastAPI):
+    # Load the grid and its indices before serving, so that the first query does not have to wait for them
+    await anyio.to_thread.run_sync(satelliteDataService.locationToGridCellsMapper.get_grid)
+    yield
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 security = HTTPBasic()
 
 class SatelliteDataService(SatelliteDataAccess):
@@ -34,19 +43,43 @@ class SatelliteDataService(SatelliteDataAccess):
         self.router.add_api_route('/getProduct', self.getProduct, methods=['GET'])
         
         self.locationToGridCellsMapper = LocationToGridCellsMapper()
-        self.delete_source_after_processing = yaml.safe_load(open('config.yml'))['processing']['delete-source']
+        self.delete_source_after_processing = load_config()['processing']['delete-source']
 
-    async def queryContainingGeometry(self, locations:Request) -> JSONResponse:
+    async def queryContainingGeometry(self, locations:Request) -> ORJSONResponse:
         logging.info('Querying for geometry..')
         locations_json = await locations.json()
-        logging.debug(f"location json contains: {str(locations_json)[:1000]}")
-        locations_gdf = gpd.GeoDataFrame.from_features(locations_json['features'])
+        logging.debug('location json contains: %.1000s', locations_json)
+        # Features without a geometry are valid GeoJSON, but can not be contained in any grid-cell, so they are dropped
+        # The remaining features keep their original positions as index, which is returned as index_right
+        positions, features = [], []
+        for position, feature in enumerate(locations_json['features']):
+            if feature.get('geometry') is not None:
+                positions.append(position)
+                features.append(feature)
+        feature_geometries = [feature['geometry'] for feature in features]
+        point_coordinates = [geometry['coordinates'] for geometry in feature_geometries
+            if geometry['type'] == 'Point' and len(geometry['coordinates']) == 2]
+        if feature_geometries and len(point_coordinates) == len(feature_geometries):
+            # Locations are usually plain points, which are created directly from their coordinates
+            geometries = shapely.points(np.array(point_coordinates, dtype=float))
+        else:
+            # Parse all geometries in a single vectorized call, instead of constructing them feature by feature
+            geometries = shapely.get_parts(shapely.from_geojson(json.dumps({
+                'type': 'GeometryCollection',
+                'geometries': feature_geometries
+            })))
+        locations_gdf = gpd.GeoDataFrame([feature.get('properties') or {} for feature in features], geometry=geometries,
+            index=positions)
         # Fallback mechanism to reduce data to duplicate-free set of points. Sent data should already be free of duplicates.
-        locations_gdf.drop_duplicates('geometry', inplace=True)
-        # Map location points to grid cells
-        grid_cells = self.locationToGridCellsMapper.mapLocationsToContainingGridCellLabels(locations_gdf)
+        # Duplicates are found by their WKB-representation, which is much cheaper to compare than the geometries
+        _, first_occurrences = np.unique(shapely.to_wkb(geometries), return_index=True)
+        if len(first_occurrences) < len(locations_gdf):
+            locations_gdf = locations_gdf.iloc[np.sort(first_occurrences)]
+        # Map location points to grid cells on a worker thread, so that the event loop is not blocked meanwhile
+        grid_cells = await anyio.to_thread.run_sync(self.locationToGridCellsMapper.mapLocationsToContainingGridCellLabels,
+            locations_gdf)
         logging.info('Query for geometry complete!')
-        return JSONResponse(json.loads(grid_cells.to_json(drop_id=True)))
+        return ORJSONResponse(grid_cells.to_geo_dict(drop_id=True))
 
     async def queryProductsMetadata(self, data:Annotated[dict, Body(
             examples=[
@@ -67,23 +100,24 @@ class SatelliteDataService(SatelliteDataAccess):
             footprint_geometry = shapely.from_wkt(footprint)
             assert isinstance(footprint_geometry, shapely.Geometry)
             # Query products
-            logging.info(f'Querying products from {datetime_from} to {datetime_to} in footprint {footprint_geometry}..')
-            data = ca.searchFootprint(footprint_geometry, datetime_from, datetime_to)
+            logging.info('Querying products from %s to %s in footprint %s..', datetime_from, datetime_to, footprint_geometry)
+            data = await anyio.to_thread.run_sync(ca.searchFootprint, footprint_geometry, datetime_from, datetime_to)
         elif 'cell_name' in data:
             cell_name: str = data['cell_name']
             # Query products
-            logging.info(f'Querying products from {datetime_from} to {datetime_to} in grid-cell {cell_name}..')
-            data = ca.searchCell(cell_name, datetime_from, datetime_to)
+            logging.info('Querying products from %s to %s in grid-cell %s..', datetime_from, datetime_to, cell_name)
+            data = await anyio.to_thread.run_sync(ca.searchCell, cell_name, datetime_from, datetime_to)
         else:
             raise HTTPException(status_code=400, detail='Neither footprint nor cell_name are defined')
         logging.info('Query for products complete!')
-        return JSONResponse(json.loads(data.to_json()))
+        return Response(data.to_json(), media_type='application/json')
     
     async def requestProduct(self, id:str, credentials:HTTPBasicCredentials = Depends(security)):
         scheduler = RequestScheduler()
-        state = scheduler.request(id, credentials.username, credentials.password)
-        scheduler.store_schedule()
-        return JSONResponse({
+        # Requesting may download the product directly, so it is run on a worker thread to not block the event loop
+        state = await anyio.to_thread.run_sync(scheduler.request, id, credentials.username, credentials.password)
+        await anyio.to_thread.run_sync(scheduler.store_schedule)
+        return ORJSONResponse({
             'id': id,
             'state': state.value
         })
@@ -94,31 +128,39 @@ class SatelliteDataService(SatelliteDataAccess):
                     'bands': ['B02', 'B03', 'B04', 'B11'],
                     'locations': ['POINT (30 10)', 'POINT (20 40)'],
                     'crs': 'EPSG:4326'
+                },
+                {
+                    'bands': ['B02', 'B03', 'B04', 'B11'],
+                    'locations': ['POINT (30 10)', 'POINT (20 40)'],
+                    'crs': 'EPSG:4326',
+                    'dtype': 'uint8'
                 }
             ]
     )]):
         self.validate_json_parameters(data, [['bands'], ['locations'], ['crs']])
-        self.logger.debug(f'Starting feature-extraction for id {id} with radius {radius} m and data:\n{data}')
+        self.logger.debug('Starting feature-extraction for id %s with radius %s m and data:\n%s', id, radius, data)
         bands: List[str] = data['bands']
+        # Optionally downcast the images, e.g. to uint8 for consumers that do not need the full dynamic range
+        out_dtype: Optional[str] = data.get('dtype')
         locations: gpd.GeoDataFrame = gpd.GeoDataFrame.from_features(data['locations'], crs=data['crs'])
         request_scheduler = RequestScheduler()
         try:
-            zip_filepath = request_scheduler.process_data_for_request(id, bands, locations, radius,
-                self.delete_source_after_processing)
+            zip_filepath = await anyio.to_thread.run_sync(request_scheduler.process_data_for_request, id, bands, locations,
+                radius, self.delete_source_after_processing, out_dtype)
         except ValueError as error:
             self.logger.debug(error)
             return PlainTextResponse(error, status_code=HTTPStatus.BAD_REQUEST)
-        self.logger.debug(f'Path of zip-file: {zip_filepath}')
-        return FileResponse(zip_filepath, filename=f'{id}.zip', background=BackgroundTask(request_scheduler.remove_request, id))
+        self.logger.debug('Path of zip-file: %s', zip_filepath)
+        return FileResponse(zip_filepath, filename=f'{id}.zip', media_type='application/zip', background=BackgroundTask(request_scheduler.remove_request, id))
 
     async def getProduct(self, id:str):
         try:
-            zip_filepath = RequestScheduler().get_raw_product(id)
+            zip_filepath = await anyio.to_thread.run_sync(RequestScheduler().get_raw_product, id)
         except ValueError as error:
             self.logger.debug(error)
             return PlainTextResponse(error, status_code=HTTPStatus.BAD_REQUEST)
-        self.logger.debug(f'Path of zip-file: {zip_filepath}')
-        return FileResponse(zip_filepath, filename=Path(zip_filepath).name)
+        self.logger.debug('Path of zip-file: %s', zip_filepath)
+        return FileResponse(zip_filepath, filename=Path(zip_filepath).name, media_type='application/zip')
 
     def validate_json_parameters(self, data:dict, parameters:List[List[str]]) -> List[List[str]]:
         '''
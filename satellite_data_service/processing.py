@@ -1,36 +1,59 @@
 import logging
 import os
 import pathlib
-import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple, Union
 from zipfile import ZipFile
 
 import geopandas as gpd
-import pandas as pd
+import numpy as np
 import rasterio
-import rasterio.mask
 import rasterio.warp
-import yaml
-from bs4 import BeautifulSoup
-from shapely import Point, Polygon, box
+import rasterio.windows
+from lxml import etree
+from rasterio.coords import BoundingBox
+from rasterio.crs import CRS
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine
+from rasterio.windows import Window
 
+from .config import load_config
+
+
+@dataclass
+class ResolutionInfo:
+    crs: CRS
+    bounds: BoundingBox
+    transform: Affine
+    width: int
+    height: int
 
 @dataclass
 class SentinelData:
-    image: rasterio.DatasetReader
+    image_path: str
     spatial_resolution: int
+    info: ResolutionInfo
+
+@dataclass
+class ImageWindow:
+    window: Window
+    transform: Affine
+    outside: np.ndarray
 
 class SentinelImageProcessor:
     image_drivers = {
         'jp2': 'JP2OpenJPEG'
     }
+    output_dtypes = ['uint8']
 
     def __init__(self) -> None:
         self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
-        config = yaml.safe_load(open('config.yml'))['processing']
+        config = load_config()['processing']
         self.data_dir: str = config['data-dir']
+        self.gdal_options: Dict[str, str] = config['gdal-options']
     
     def remove(self, id:str):
         filepath = os.path.join(self.data_dir, f'{id}.zip')
@@ -38,9 +61,10 @@ class SentinelImageProcessor:
             self.logger.debug(f'Removing zip for id {id}..')
             os.remove(filepath)
 
-    def process(self, input_dir:str, id:str, bands:List[str], locations:gpd.GeoDataFrame, radius:float) -> str:
-        if not os.path.exists(input_dir):
-            raise ValueError(f'No such directory: {input_dir}')
+    def process(self, input_path:str, id:str, bands:List[str], locations:gpd.GeoDataFrame, radius:float,
+            out_dtype:Optional[str] = None) -> str:
+        if not os.path.exists(input_path):
+            raise ValueError(f'No such file or directory: {input_path}')
         if not bands:
             raise ValueError('Bands may not be empty')
         if len(locations) == 0:
@@ -50,67 +74,106 @@ class SentinelImageProcessor:
             raise ValueError('Locations must have a "name" column that will be used for the filenames')
         if radius < 0.0:
             raise ValueError('Radius may not be negative')
-        # Prepare path hierarchy
-        metadata_filepath = os.path.join(input_dir, next(filter(lambda x: x.startswith('MTD'), os.listdir(input_dir))))
-        self.logger.debug(f'Metadata path: {metadata_filepath}')
-        images_dir = os.path.join(input_dir, 'GRANULE')
-        images_dir = os.path.join(images_dir, os.listdir(images_dir)[0], 'IMG_DATA')
-        self.logger.debug(f'Image path: {images_dir}')
-        # Get spatial resolutions per band - 10 m, 20 m, 60 m
-        spatial_resolutions = self.get_spatial_resolutions(metadata_filepath)
-        self.logger.debug(f'Bands: {bands}')
-        bands_meta_style: List[str] = [self.get_band_name_for_meta(band) for band in bands]
-        # Ensure all band names are valid
-        malformed_bands = list(map(lambda tuple: bands[tuple[0]],
-            filter(lambda tuple: tuple[1] not in spatial_resolutions, enumerate(bands_meta_style))))
-        if any(malformed_bands):
-            raise ValueError(f'Band names {malformed_bands} do not exist')
-        # Load data for all bands
-        data = {band: self.load_band_data(images_dir, spatial_resolutions, self.get_band_name_for_files(band))
-            for band in bands_meta_style}
-        all_crs = [band.image.crs for band in data.values()]
-        if len(set(all_crs)) > 1:
-            raise RuntimeError(f'Expected a single CRS, but got multiple: {all_crs}')
-        used_crs = all_crs[0]
-        if used_crs is None:
-            raise ValueError('The sentinel data does not have a CRS set! Should never happen!')
-        self.logger.debug(f'Locations CRS: {locations.crs}, Sentinel CRS: {used_crs}')
-        # Transform locations to CRS of sentinel data
-        if locations.crs != used_crs:
-            locations['geometry'] = locations['geometry'].apply(
-                lambda position: self.reproject_point(position, locations.crs, used_crs))
-        # Build areas of obeservation around locations
-        locations['bbox'] = locations['geometry'].apply(
-            lambda position: self.get_area_of_observation(position, radius))
-        # Remove bounding boxes that are not completely contained in the data bounds
-        data_bounds = list(data.values())[0].image.bounds
-        data_bounds: Polygon = box(data_bounds.left, data_bounds.bottom, data_bounds.right, data_bounds.top)
-        self.logger.debug(f'Data bounds: {data_bounds}')
-        locations['contained'] = locations['bbox'].apply(lambda bbox: data_bounds.contains(bbox))
-        outside_locations = locations[~locations['contained']]
-        self.logger.debug(f'The bounding boxes of the following locations are outside the data bounds: {outside_locations.name}')
-        locations = locations[locations['contained']]
-        # Extract data in bounding boxes from whole data and write to files
-        out_dir = os.path.join(self.data_dir, id)
-        os.makedirs(out_dir, exist_ok=True)
-        for band_name, band in data.items():
-            out_band_dir = os.path.join(out_dir, band_name)
-            os.makedirs(out_band_dir, exist_ok=True)
-            out_data: pd.Series = locations['bbox'].apply(lambda bbox: self.transform_image(band.image, bbox))
-            named_out_data = pd.DataFrame({'name': locations['name'], 'out': out_data})
-            named_out_data.apply(lambda row: self.image_to_file(
-                    row['out'][0],
-                    row['out'][1],
-                    row['out'][2],
-                    os.path.join(out_band_dir, row['name'] + '.jp2'),
-                    SentinelImageProcessor.image_drivers['jp2']
-                ), axis=1)
-        # Pack all data in a zip file
-        archive = shutil.make_archive(out_dir, 'zip', root_dir=self.data_dir, base_dir=id)
-        # Remove source folder
-        shutil.rmtree(out_dir)
-        return archive
+        if out_dtype is not None and out_dtype not in SentinelImageProcessor.output_dtypes:
+            raise ValueError(f'Output dtype {out_dtype} is not supported, use one of {SentinelImageProcessor.output_dtypes}')
+        # The GDAL options configure how the product is read, like caching the blocks of the /vsizip/ or remote files
+        with rasterio.Env(**self.gdal_options):
+            # Prepare path hierarchy
+            product_dir = self.get_product_dir(input_path)
+            metadata_filepath = next(filter(lambda x: x.name.startswith('MTD'), product_dir.iterdir()))
+            self.logger.debug(f'Metadata path: {metadata_filepath}')
+            images_dir = next((product_dir / 'GRANULE').iterdir()) / 'IMG_DATA'
+            self.logger.debug(f'Image path: {images_dir}')
+            images = self.get_images(images_dir)
+            # Get spatial resolutions per band - 10 m, 20 m, 60 m
+            spatial_resolutions = self.get_spatial_resolutions(metadata_filepath)
+            self.logger.debug(f'Bands: {bands}')
+            bands_meta_style: List[str] = [self.get_band_name_for_meta(band) for band in bands]
+            # Ensure all band names are valid
+            malformed_bands = list(map(lambda tuple: bands[tuple[0]],
+                filter(lambda tuple: tuple[1] not in spatial_resolutions, enumerate(bands_meta_style))))
+            if any(malformed_bands):
+                raise ValueError(f'Band names {malformed_bands} do not exist')
+            # Load data for all bands
+            # Bands of the same spatial resolution share their pixel grid, so only one image per resolution is opened
+            # to read the grid, while each image is opened for reading its pixels only during the extraction
+            resolution_infos: Dict[int, ResolutionInfo] = {}
+            data = {band: self.load_band_data(images, spatial_resolutions, self.get_band_name_for_files(band), resolution_infos)
+                for band in bands_meta_style}
+            first_band = next(iter(data.values()))
+            used_crs = first_band.info.crs
+            if any(info.crs != used_crs for info in resolution_infos.values()):
+                raise RuntimeError(f'Expected a single CRS, but got multiple: {[info.crs for info in resolution_infos.values()]}')
+            if used_crs is None:
+                raise ValueError('The sentinel data does not have a CRS set! Should never happen!')
+            self.logger.debug(f'Locations CRS: {locations.crs}, Sentinel CRS: {used_crs}')
+            data_bounds = first_band.info.bounds
+            self.logger.debug(f'Data bounds: {data_bounds}')
+            # Transform locations to CRS of sentinel data
+            if locations.crs != used_crs:
+                # Only locations within the data bounds can have their areas of observation contained in them,
+                # so the others are dropped before reprojecting, using the enclosing bounds in the CRS of the locations
+                left, bottom, right, top = rasterio.warp.transform_bounds(used_crs, locations.crs, *data_bounds)
+                x, y = locations.geometry.x, locations.geometry.y
+                if left <= right:
+                    near = (x >= left) & (x <= right) & (y >= bottom) & (y <= top)
+                else:
+                    # The bounds of data crossing the antimeridian wrap around, so they extend to the right of left
+                    # and to the left of right
+                    near = ((x >= left) | (x <= right)) & (y >= bottom) & (y <= top)
+                self.logger.debug(f'The following locations are outside the data bounds: {locations[~near].name}')
+                locations = locations[near].to_crs(used_crs)
+            # Build areas of obeservation around locations, kept as plain coordinate arrays instead of box geometries
+            x, y = locations.geometry.x.to_numpy(), locations.geometry.y.to_numpy()
+            min_x, min_y, max_x, max_y = x - radius, y - radius, x + radius, y + radius
+            # Remove bounding boxes that are not completely contained in the data bounds
+            # The data bounds are axis-aligned, so the containment reduces to comparing the bounds of the bounding boxes
+            contained = (min_x >= data_bounds.left) & (max_x <= data_bounds.right) \
+                & (min_y >= data_bounds.bottom) & (max_y <= data_bounds.top)
+            self.logger.debug(f'The bounding boxes of the following locations are outside the data bounds: {locations[~contained].name}')
+            locations = locations[contained]
+            min_x, min_y, max_x, max_y = min_x[contained], min_y[contained], max_x[contained], max_y[contained]
+            # The windows are computed once per pixel grid, i.e. per spatial resolution
+            windows: Dict[int, List[ImageWindow]] = {resolution: self.get_windows(info, min_x, min_y, max_x, max_y)
+                for resolution, info in resolution_infos.items()}
+            # Extract data in bounding boxes from whole data and write to files
+            os.makedirs(self.data_dir, exist_ok=True)
+            archive = os.path.join(self.data_dir, f'{id}.zip')
+            # The images are written straight into the zip file without compression, since JPEG2000 is compressed already
+            try:
+                with ZipFile(archive, 'w', compression=zipfile.ZIP_STORED) as archive_file, \
+                        ThreadPoolExecutor(max_workers=min(len(data), os.cpu_count() or 1)) as executor:
+                    # The bands are extracted in parallel, which is possible since GDAL releases the GIL while reading and
+                    # writing. Each band is handled by a single thread, which opens its own dataset, since datasets must not
+                    # be shared between threads.
+                    futures = [executor.submit(self.extract_band, band, locations['name'].to_numpy(),
+                            windows[band.spatial_resolution], f'{id}/{band_name}', out_dtype)
+                        for band_name, band in data.items()]
+                    for future in futures:
+                        for image_name, image in future.result():
+                            archive_file.writestr(image_name, image)
+            except BaseException:
+                if os.path.exists(archive):
+                    os.remove(archive)
+                raise
+            return archive
     
+    def extract_band(self, band:SentinelData, names:np.ndarray, windows:List[ImageWindow], out_band_dir:str,
+            out_dtype:Optional[str] = None) -> List[Tuple[str, bytes]]:
+        images = []
+        with self.open_image(band.image_path) as image:
+            for name, window in zip(names, windows):
+                out_image, out_transform, out_meta = self.transform_image(image, window)
+                if out_dtype == 'uint8':
+                    out_image = self.scale_to_uint8(out_image)
+                    out_meta.update({
+                        'dtype': 'uint8',
+                        # rasterio returns the nodata value as float, which can not be shifted like the image
+                        'nodata': None if out_meta['nodata'] is None else min(int(out_meta['nodata']) >> 4, 255)
+                    })
+                images.append((f'{out_band_dir}/{name}.jp2', self.image_to_bytes(out_image, out_transform, out_meta, 'jp2')))
+        return images
+
     def get_band_name_for_files(self, name:str) -> str:
         if len(name) < 3:
             # B7 to B07
@@ -123,55 +186,101 @@ class SentinelImageProcessor:
             return name[0] + name[2:]
         return name
     
-    def get_spatial_resolutions(self, metadata_filepath:str) -> Dict[str, int]:
-        with open(metadata_filepath, 'r') as file:
-            metadata = file.read()
-        metadata_soup = BeautifulSoup(metadata, 'xml')
-        spectral_infos = metadata_soup.find_all('Spectral_Information')
+    def get_product_dir(self, input_path:str) -> Union[Path, zipfile.Path]:
+        if os.path.isfile(input_path):
+            # Read the product in-place from an archive like S2A_MSIL1C_20220104T103431_N0301_R108_T32UMA_20220104T123507.zip
+            # that contains S2A_MSIL1C_20220104T103431_N0301_R108_T32UMA_20220104T123507.SAFE/
+            return next(zipfile.Path(input_path).iterdir())
+        return Path(input_path)
+
+    def get_raster_path(self, path:Union[Path, zipfile.Path]) -> str:
+        if isinstance(path, zipfile.Path):
+            # GDAL virtual file system path like /vsizip/path/to/archive.zip/path/inside/archive.jp2
+            return f'/vsizip/{path}'
+        return str(path)
+
+    def get_spatial_resolutions(self, metadata_filepath:Union[Path, zipfile.Path]) -> Dict[str, int]:
         spatial_resolutions = {}
-        for info in spectral_infos:
-            band_name = info.get('physicalBand')
-            spatial_resolutions[band_name] = int(info.RESOLUTION.string)
+        # Only the spectral information is needed, so the elements are read and discarded while parsing
+        with metadata_filepath.open('rb') as file:
+            for _, info in etree.iterparse(file, tag='{*}Spectral_Information'):
+                band_name = info.get('physicalBand')
+                spatial_resolutions[band_name] = int(info.findtext('{*}RESOLUTION'))
+                info.clear()
         self.logger.debug(f'Spatial resolutions: {spatial_resolutions}')
         return spatial_resolutions
     
-    def get_image_path(self, images_dir:str, name:str) -> str:
-        filename = next(filter(lambda img: img.find(name) >= 0, os.listdir(images_dir)))
-        return os.path.join(images_dir, filename)
+    def get_images(self, images_dir:Union[Path, zipfile.Path]) -> Dict[str, Union[Path, zipfile.Path]]:
+        # List the images only once, keyed by their band like T32UMA_20220104T103431_B02.jp2 -> B02
+        return {pathlib.PurePath(image.name).stem.split('_')[-1]: image for image in images_dir.iterdir()}
+
+    def get_image_path(self, images:Dict[str, Union[Path, zipfile.Path]], name:str) -> str:
+        image = images.get(name)
+        if image is None:
+            image = next(filter(lambda img: img.name.find(name) >= 0, images.values()))
+        return self.get_raster_path(image)
 
-    def open_image(self, images_dir:str, name:str) -> rasterio.DatasetReader:
-        image_path = self.get_image_path(images_dir, name)
+    def open_image(self, image_path:str) -> rasterio.DatasetReader:
         return rasterio.open(image_path,
             driver=SentinelImageProcessor.image_drivers[pathlib.Path(image_path).suffix[1:]])
 
-    def load_band_data(self, images_dir:str, spatial_resolutions:Dict[str, int], band_name:str) -> SentinelData:
-        image = self.open_image(images_dir, self.get_band_name_for_files(band_name))
+    def load_band_data(self, images:Dict[str, Union[Path, zipfile.Path]], spatial_resolutions:Dict[str, int], band_name:str,
+            resolution_infos:Dict[int, ResolutionInfo]) -> SentinelData:
+        image_path = self.get_image_path(images, self.get_band_name_for_files(band_name))
         spatial_resolution = spatial_resolutions[self.get_band_name_for_meta(band_name)]
-        return SentinelData(image, spatial_resolution)
-    
-    def reproject_point(self, point:Point, crs_from, crs_to) -> Point:
-        return Point(rasterio.warp.transform_geom(crs_from, crs_to, point)['coordinates'])
+        if spatial_resolution not in resolution_infos:
+            with self.open_image(image_path) as image:
+                resolution_infos[spatial_resolution] = ResolutionInfo(image.crs, image.bounds, image.transform,
+                    image.width, image.height)
+        return SentinelData(image_path, spatial_resolution, resolution_infos[spatial_resolution])
     
-    def get_area_of_observation(self, point:Point, radius:float) -> Polygon:
-        return box(
-            point.x - radius,
-            point.y - radius,
-            point.x + radius,
-            point.y + radius
-        )
-    
-    def transform_image(self, band: rasterio.DatasetReader, bounding_box:Polygon):
-        out_image, out_transform = rasterio.mask.mask(band, [bounding_box], crop=True)
+    def get_windows(self, info:ResolutionInfo, min_x:np.ndarray, min_y:np.ndarray, max_x:np.ndarray,
+            max_y:np.ndarray) -> List[ImageWindow]:
+        # The bounding boxes are axis-aligned, so masking them reduces to window reads without rasterizing polygons,
+        # which yields the same output as rasterio.mask.mask with crop=True
+        # The pixel offsets of all bounding boxes are computed at once from the corners of the boxes
+        cols, rows = ~info.transform * (np.stack([min_x, max_x, max_x, min_x]), np.stack([max_y, max_y, min_y, min_y]))
+        col_starts = np.clip(np.floor(cols.min(axis=0)), 0, info.width).astype(int)
+        col_stops = np.clip(np.ceil(cols.max(axis=0)), 0, info.width).astype(int)
+        row_starts = np.clip(np.floor(rows.min(axis=0)), 0, info.height).astype(int)
+        row_stops = np.clip(np.ceil(rows.max(axis=0)), 0, info.height).astype(int)
+        # Bounding boxes without an area, like for a radius of zero, still yield a single pixel, like rasterio.mask.mask does
+        col_starts = np.minimum(col_starts, info.width - 1)
+        row_starts = np.minimum(row_starts, info.height - 1)
+        col_stops = np.maximum(col_stops, col_starts + 1)
+        row_stops = np.maximum(row_stops, row_starts + 1)
+        windows = []
+        for i in range(len(col_starts)):
+            window = Window(col_starts[i], row_starts[i], col_stops[i] - col_starts[i], row_stops[i] - row_starts[i])
+            out_transform = rasterio.windows.transform(window, info.transform)
+            # Pixels are part of the bounding box if their centers are, where centers on the left edge are excluded,
+            # but on the right, top and bottom edges included, which matches how GDAL rasterizes the bounding box
+            center_cols, center_rows = np.meshgrid(np.arange(window.width) + 0.5, np.arange(window.height) + 0.5)
+            center_x, center_y = out_transform * (center_cols, center_rows)
+            inside = (center_x > min_x[i]) & (center_x <= max_x[i]) & (center_y >= min_y[i]) & (center_y <= max_y[i])
+            windows.append(ImageWindow(window, out_transform, ~inside))
+        return windows
+
+    def transform_image(self, band: rasterio.DatasetReader, window:ImageWindow):
+        out_image = band.read(window=window.window)
+        out_image[:, window.outside] = band.nodata if band.nodata is not None else 0
         out_meta = band.meta
-        return out_image, out_transform, out_meta
+        return out_image, window.transform, out_meta
     
-    def image_to_file(self, out_image, out_transform, out_meta, filepath:str, driver:str):
+    def scale_to_uint8(self, image:np.ndarray) -> np.ndarray:
+        # The reflectances are quantized with 12 bits, so dropping the lowest 4 bits maps them to 8 bits,
+        # while the rare brighter values saturate
+        return np.minimum(np.right_shift(image, 4), 255).astype(np.uint8)
+
+    def image_to_bytes(self, out_image, out_transform, out_meta, extension:str) -> bytes:
         out_meta.update({
-            "driver": driver,
+            "driver": SentinelImageProcessor.image_drivers[extension],
             "height": out_image.shape[1],
             "width": out_image.shape[2],
             "transform": out_transform
         })
-        self.logger.debug(f'Writing to file {filepath}')
-        with rasterio.open(filepath, "w", **out_meta) as dest:
-            dest.write(out_image)
\ No newline at end of file
+        # The extension is required for the driver to write the georeferencing into the image
+        with MemoryFile(ext=extension) as file:
+            with file.open(**out_meta) as dest:
+                dest.write(out_image)
+            return file.read()
\ No newline at end of file